@@ -1,34 +1,45 @@
 # /// script
 # requires-python = ">=3.12"
 # dependencies = [
+#     "cachetools",
 #     "litestar",
+#     "orjson",
 #     "python-multipart",
 #     "sniffio",
-#     "uvicorn",
+#     "uvicorn[standard]",
 # ]
 # ///
 
 import asyncio
-import http.server
+import hashlib
 import json
 import os
 import re
 import shutil
-import socketserver
+import signal
 import subprocess
 import sys
+import tempfile
 import threading
+import urllib.parse
 import uuid
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, suppress
+from dataclasses import dataclass, field, replace
+from functools import lru_cache
 from pathlib import Path
-from threading import Lock
-from typing import Annotated, AsyncGenerator
+from typing import Annotated, AsyncGenerator, Callable
 
+import orjson
+from cachetools import TTLCache
 from litestar import Litestar, get, post
 from litestar.config.cors import CORSConfig
+from litestar.datastructures import State
 from litestar.enums import RequestEncodingType
 from litestar.params import Body
 from litestar.response import File, Stream
+from litestar.static_files import create_static_files_router
 
 # --- CONFIGURATION ---
 BASE_DIR = Path(__file__).parent.absolute()
@@ -39,6 +50,32 @@ WEB_DIR = BASE_DIR / "web_ui"
 MAKE_SH_PATH = BASE_DIR / "make.sh"
 ICON_FILENAME = "icon.png"
 CONF_FILENAME = "webapk.conf"
+# APK downloads are streamed in few, large chunks
+APK_CHUNK_SIZE = 4 * 1024 * 1024
+# Uploaded site archives stay in memory up to this size, then spill to disk
+UPLOAD_SPOOL_SIZE = 32 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+LAST_BUILD_PATH = CACHE_DIR / "last_build.json"
+LAST_APP_PATH = CACHE_DIR / "last_app.json"
+
+# Let Gradle reuse its build cache and daemon across our builds. Workers are
+# capped because past a handful of cores they mostly contend for memory
+GRADLE_WORKERS = min(os.cpu_count() or 1, 4)
+GRADLE_OPTS = (
+    "-Dorg.gradle.caching=true -Dorg.gradle.parallel=true -Dorg.gradle.daemon=true"
+    f" -Dorg.gradle.workers.max={GRADLE_WORKERS}"
+)
+
+# Environment shared by every make.sh invocation, built once
+BUILD_ENV = {
+    **os.environ,
+    "ANDROID_PROJECT_ROOT": str(ANDROID_DIR),
+    "CACHE_DIR": str(CACHE_DIR),
+    # Keep whatever the user already exports (proxy, truststore, ...)
+    "GRADLE_OPTS": f"{os.environ.get('GRADLE_OPTS', '')} {GRADLE_OPTS}".strip(),
+}
+# Prefix of every make.sh invocation, so calls only add their target
+MAKE_COMMAND = ("bash", str(MAKE_SH_PATH))
 
 OUTPUT_DIR.mkdir(exist_ok=True)
 CACHE_DIR.mkdir(exist_ok=True)
@@ -46,18 +83,10 @@ CACHE_DIR.mkdir(exist_ok=True)
 # --- GIT URL CONVERSION ---
 
 
-def convert_git_to_raw_url(
-    repo_url: str, branch: str = "main", entry_path: str = "index.html"
-) -> str:
-    """
-    Convert a Git repository URL to a served URL for live loading.
-    Uses raw.githack.com for GitHub (serves with correct MIME types as web pages).
-    """
-    import urllib.parse
-
-    parsed = urllib.parse.urlparse(repo_url)
-    host = parsed.netloc.lower()
-    path = parsed.path.rstrip("/")
+@lru_cache(maxsize=256)
+def parse_git_url(repo_url: str) -> tuple[str, str]:
+    """Extract (user, repo) from a Git repository URL."""
+    path = urllib.parse.urlparse(repo_url).path.rstrip("/")
 
     # Remove .git suffix if present
     if path.endswith(".git"):
@@ -68,8 +97,20 @@ def convert_git_to_raw_url(
     if len(parts) < 2:
         raise ValueError(f"Invalid repository URL: {repo_url}")
 
-    user = parts[0]
-    repo = parts[1]
+    return parts[0], parts[1]
+
+
+@lru_cache(maxsize=256)
+def convert_git_to_raw_url(
+    repo_url: str, branch: str = "main", entry_path: str = "index.html"
+) -> str:
+    """
+    Convert a Git repository URL to a served URL for live loading.
+    Uses raw.githack.com for GitHub (serves with correct MIME types as web pages).
+    """
+    parsed = urllib.parse.urlparse(repo_url)
+    host = parsed.netloc.lower()
+    user, repo = parse_git_url(repo_url)
 
     # Normalize entry path
     entry_path = entry_path.lstrip("/")
@@ -590,142 +631,350 @@ public class MainActivity extends AppCompatActivity {
 
 # --- HELPERS ---
 
-build_states = {}
-build_states_lock = Lock()
+# Every placeholder used by the templates above
+PLACEHOLDER_RE = re.compile(
+    r"(APP_ID|MAIN_URL|GIT_USER|GIT_REPO|GIT_BRANCH|GIT_ENTRY)_PLACEHOLDER"
+)
+
+
+def split_template(template: str) -> tuple[str, ...]:
+    """Literal chunks at even indices, placeholder names at odd ones."""
+    return tuple(PLACEHOLDER_RE.split(template))
+
+
+# Split once at import so rendering is just a join
+BUILD_GRADLE_PARTS = split_template(BUILD_GRADLE_TEMPLATE)
+MAIN_ACTIVITY_PARTS = split_template(MAIN_ACTIVITY_TEMPLATE)
+MAIN_ACTIVITY_GIT_PARTS = split_template(MAIN_ACTIVITY_GIT_TEMPLATE)
+
+
+def render_template(parts: tuple[str, ...], values: dict[str, str]) -> str:
+    rendered = list(parts)
+    rendered[1::2] = [values[name] for name in parts[1::2]]
+    return "".join(rendered)
+
+
+# Builds are forgotten an hour after they start; the cap bounds memory
+BUILD_STATES_MAX = 1024
+BUILD_STATES_TTL = 3600
+
+
+def sse_frame(payload: dict, event: str = None) -> bytes:
+    """Encodes one server-sent event, ready to be written as-is."""
+    data = b"data: " + orjson.dumps(payload) + b"\n\n"
+    return b"event: " + event.encode() + b"\n" + data if event else data
+
+
+INVALID_ID_FRAME = sse_frame({"error": "Invalid ID"}, "error")
+
+
+@dataclass(frozen=True, slots=True)
+class BuildState:
+    """Immutable snapshot of a build; updates replace it as a whole."""
+
+    status: str = "in_progress"
+    progress: int = 0
+    message: str = "Starting..."
+    error: str | None = None
+    apk_path: str | None = None
+    apk_filename: str | None = None
+
+    def to_dict(self) -> dict:
+        # The APK location stays server-side; download() reads it from the state
+        payload = {
+            "status": self.status,
+            "progress": self.progress,
+            "message": self.message,
+        }
+        if self.error is not None:
+            payload["error"] = self.error
+        return payload
+
+    def to_frame(self) -> bytes:
+        return sse_frame(self.to_dict())
+
+
+@dataclass(slots=True)
+class BuildRecord:
+    """Per-build slot in build_states; holders keep a direct reference to it."""
+
+    state: BuildState = field(default_factory=BuildState)
+    # Set and swapped for a fresh one on every update, which wakes every
+    # progress stream waiting on it without them polling
+    changed: asyncio.Event = field(default_factory=asyncio.Event)
+    # SSE frame for the current state, serialized once per transition and
+    # shared by every subscriber; seq tells them when it has moved on
+    frame: bytes = b""
+    seq: int = 0
+
+    def __post_init__(self) -> None:
+        self.frame = self.state.to_frame()
+
+    def update(self, **changes) -> None:
+        state = replace(self.state, **changes)
+        if state == self.state:
+            return
+        self.state = state
+        self.frame = state.to_frame()
+        self.seq += 1
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+
+# Only ever touched from the event loop, and each update swaps in a new
+# snapshot in a single assignment, so readers never need a lock
+build_states = TTLCache(maxsize=BUILD_STATES_MAX, ttl=BUILD_STATES_TTL)
+
+
+# Every build rewrites the single android_source/ tree, so builds beyond
+# this limit wait for their turn instead of clobbering each other
+MAX_CONCURRENT_BUILDS = 1
+build_semaphore = asyncio.Semaphore(MAX_CONCURRENT_BUILDS)
+
+# Blocking build steps (extraction, source rewrites) run here rather than on
+# asyncio's shared default executor; one worker per build slot is enough
+BUILD_POOL = ThreadPoolExecutor(
+    max_workers=MAX_CONCURRENT_BUILDS, thread_name_prefix="apkbuild"
+)
+
+
+async def run_blocking(func: Callable, *args):
+    return await asyncio.get_running_loop().run_in_executor(BUILD_POOL, func, *args)
+
+
+# Gradle progress updates are coalesced and published at most this often
+PROGRESS_FLUSH_INTERVAL = 0.1
 
 # Gradle task patterns and their progress weights
 # These tasks appear in order during an Android build
-GRADLE_TASKS = [
-    (r"preBuild", 5),
-    (r"preReleaseBuild", 8),
-    (r"compileReleaseAidl", 10),
-    (r"compileReleaseRenderscript", 12),
-    (r"generateReleaseBuildConfig", 15),
-    (r"generateReleaseResValues", 18),
-    (r"generateReleaseResources", 20),
-    (r"mergeReleaseResources", 25),
-    (r"processReleaseResources", 30),
-    (r"compileReleaseJavaWithJavac", 45),
-    (r"compileReleaseSources", 50),
-    (r"mergeReleaseJavaResource", 55),
-    (r"dexBuilderRelease", 60),
-    (r"mergeDexRelease", 70),
-    (r"mergeReleaseJniLibFolders", 72),
-    (r"mergeReleaseNativeLibs", 75),
-    (r"packageRelease", 85),
-    (r"assembleRelease", 90),
-    (r"signReleaseBundle", 92),
-    (r"BUILD SUCCESSFUL", 95),
-]
-
-
-def run_command(command: list[str], cwd: Path, output_target_dir: Path = None) -> None:
-    env = os.environ.copy()
-    env["ANDROID_PROJECT_ROOT"] = str(ANDROID_DIR)
-    env["CACHE_DIR"] = str(CACHE_DIR)
+GRADLE_TASKS = (
+    (b"preBuild", 5),
+    (b"preReleaseBuild", 8),
+    (b"compileReleaseAidl", 10),
+    (b"compileReleaseRenderscript", 12),
+    (b"generateReleaseBuildConfig", 15),
+    (b"generateReleaseResValues", 18),
+    (b"generateReleaseResources", 20),
+    (b"mergeReleaseResources", 25),
+    (b"processReleaseResources", 30),
+    (b"compileReleaseJavaWithJavac", 45),
+    (b"compileReleaseSources", 50),
+    (b"mergeReleaseJavaResource", 55),
+    (b"dexBuilderRelease", 60),
+    (b"mergeDexRelease", 70),
+    (b"mergeReleaseJniLibFolders", 72),
+    (b"mergeReleaseNativeLibs", 75),
+    (b"packageRelease", 85),
+    (b"assembleRelease", 90),
+    (b"signReleaseBundle", 92),
+    (b"BUILD SUCCESSFUL", 95),
+)
+GRADLE_TASK_PROGRESS = dict(GRADLE_TASKS)
+# One alternation compiled up front so each raw log line is scanned once
+GRADLE_TASK_RE = re.compile(b"|".join(map(re.escape, GRADLE_TASK_PROGRESS)))
+
+# Subprocess output is read in raw chunks of this size
+OUTPUT_READ_SIZE = 1 << 16
+
+
+class GradleProgress:
+    """Turns Gradle log lines into coalesced build state updates."""
+
+    def __init__(self, record: BuildRecord, base_progress: int) -> None:
+        self.record = record
+        self.base_progress = base_progress
+        self.last_progress = base_progress
+        # Pending state changes are published by a single deferred flush
+        # instead of on every matching log line
+        self.pending = {}
+        self.flush_handle = None
+        self.loop = asyncio.get_running_loop()
+
+    def __call__(self, line: bytes) -> None:
+        # Lines stay as bytes; only the rare ones that advance progress are decoded
+        pending = self.pending
+
+        # Check for task patterns
+        match = GRADLE_TASK_RE.search(line)
+        if match:
+            pattern = match.group()
+            # Scale progress: base_progress to 95
+            scaled_progress = self.base_progress + int(
+                (GRADLE_TASK_PROGRESS[pattern] / 100) * (95 - self.base_progress)
+            )
+            if scaled_progress > self.last_progress:
+                self.last_progress = scaled_progress
+                # Extract a cleaner task name
+                line_stripped = line.decode("utf-8", errors="replace").strip()
+                if ">" in line_stripped:
+                    task_part = line_stripped.split(">")[-1].strip()
+                    current_task = task_part[:50] if len(task_part) > 50 else task_part
+                else:
+                    current_task = pattern.decode()
+
+                pending["progress"] = scaled_progress
+                pending["message"] = f"Building: {current_task}"
+
+        # Also check for downloading dependencies (first build)
+        if b"Download" in line:
+            pending["message"] = "Downloading dependencies..."
+        elif b"Compiling" in line:
+            pending["message"] = "Compiling source code..."
+
+        if pending and self.flush_handle is None:
+            self.flush_handle = self.loop.call_later(
+                PROGRESS_FLUSH_INTERVAL, self.flush
+            )
+
+    def flush(self) -> None:
+        self.flush_handle = None
+        if self.pending:
+            self.record.update(status="in_progress", **self.pending)
+            self.pending.clear()
+
+    def close(self) -> None:
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+        self.flush()
+
+
+async def run_command(
+    command: list[str],
+    cwd: Path,
+    output_target_dir: Path = None,
+    on_line: Callable[[bytes], None] = None,
+) -> None:
+    """Run a build step, feeding each raw output line to on_line if given."""
+    env = BUILD_ENV
     if output_target_dir:
-        env["OUTPUT_DIR"] = str(output_target_dir)
+        env = {**BUILD_ENV, "OUTPUT_DIR": str(output_target_dir)}
 
-    subprocess.run(
-        command,
+    process = await asyncio.create_subprocess_exec(
+        *command,
         cwd=cwd,
         env=env,
-        check=True,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT,
+        # Own process group, so a cancelled step can take Gradle down with bash
+        start_new_session=True,
     )
 
+    output_chunks = []
+    buffer = bytearray()
+    try:
+        while chunk := await process.stdout.read(OUTPUT_READ_SIZE):
+            output_chunks.append(chunk)
+            if on_line is None:
+                continue
+            buffer += chunk
+            end = buffer.rfind(b"\n")
+            if end == -1:
+                continue
+            for line in buffer[:end].split(b"\n"):
+                on_line(line)
+            del buffer[: end + 1]
+        if buffer:
+            on_line(bytes(buffer))
+
+        await process.wait()
+    except BaseException:
+        # Cancelled or failed mid-stream: don't leave bash/Gradle orphaned
+        if process.returncode is None:
+            # The group may already be gone if bash was reaped but returncode
+            # isn't set yet; the original exception must still propagate
+            with suppress(ProcessLookupError):
+                os.killpg(process.pid, signal.SIGKILL)
+            await process.wait()
+        raise
+
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(
+            process.returncode, command, output=b"".join(output_chunks)
+        )
 
-def run_gradle_with_progress(
+
+async def run_gradle_with_progress(
     command: list[str],
     cwd: Path,
-    build_id: str,
+    record: BuildRecord,
     base_progress: int = 60,
     output_target_dir: Path = None,
 ) -> None:
     """Run Gradle command with real-time progress tracking."""
-    env = os.environ.copy()
-    env["ANDROID_PROJECT_ROOT"] = str(ANDROID_DIR)
-    env["CACHE_DIR"] = str(CACHE_DIR)
-    if output_target_dir:
-        env["OUTPUT_DIR"] = str(output_target_dir)
-
-    process = subprocess.Popen(
-        command,
-        cwd=cwd,
-        env=env,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        text=True,
-        bufsize=1,
+    progress = GradleProgress(record, base_progress)
+    try:
+        await run_command(command, cwd, output_target_dir, on_line=progress)
+    finally:
+        progress.close()
+
+
+def build_fingerprint(app_id: str, git_info: dict = None) -> str:
+    """Hash of everything that makes a previous Gradle build unsafe to reuse."""
+    payload = json.dumps(
+        [
+            app_id,
+            BUILD_GRADLE_TEMPLATE,
+            MAIN_ACTIVITY_TEMPLATE,
+            MAIN_ACTIVITY_GIT_TEMPLATE,
+            git_info,
+        ],
+        sort_keys=True,
     )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
 
-    current_task = "Starting Gradle..."
-    last_progress = base_progress
-    output_lines = []
+def load_last_fingerprint() -> str | None:
+    try:
+        return json.loads(LAST_BUILD_PATH.read_text(encoding="utf-8"))["fingerprint"]
+    except (OSError, ValueError, KeyError):
+        return None
 
-    for line in process.stdout:
-        output_lines.append(line)
-        line_stripped = line.strip()
 
-        # Check for task patterns
-        for pattern, progress_value in GRADLE_TASKS:
-            if pattern in line_stripped:
-                # Scale progress: base_progress to 95
-                scaled_progress = base_progress + int(
-                    (progress_value / 100) * (95 - base_progress)
-                )
-                if scaled_progress > last_progress:
-                    last_progress = scaled_progress
-                    # Extract a cleaner task name
-                    if ">" in line_stripped:
-                        task_part = line_stripped.split(">")[-1].strip()
-                        current_task = (
-                            task_part[:50] if len(task_part) > 50 else task_part
-                        )
-                    else:
-                        current_task = pattern
-
-                    with build_states_lock:
-                        build_states[build_id].update(
-                            {
-                                "progress": last_progress,
-                                "message": f"Building: {current_task}",
-                                "status": "in_progress",
-                            }
-                        )
-                break
+def save_last_fingerprint(fingerprint: str | None) -> None:
+    if fingerprint is None:
+        LAST_BUILD_PATH.unlink(missing_ok=True)
+    else:
+        LAST_BUILD_PATH.write_text(
+            json.dumps({"fingerprint": fingerprint}), encoding="utf-8"
+        )
 
-        # Also check for downloading dependencies (first build)
-        if "Downloading" in line_stripped or "Download" in line_stripped:
-            with build_states_lock:
-                build_states[build_id].update(
-                    {
-                        "message": "Downloading dependencies...",
-                        "status": "in_progress",
-                    }
-                )
-        elif "Compiling" in line_stripped:
-            with build_states_lock:
-                build_states[build_id].update(
-                    {
-                        "message": "Compiling source code...",
-                        "status": "in_progress",
-                    }
-                )
 
-    process.wait()
+def load_last_app_id() -> str | None:
+    try:
+        return json.loads(LAST_APP_PATH.read_text(encoding="utf-8"))["app_id"]
+    except (OSError, ValueError, KeyError):
+        return None
 
-    if process.returncode != 0:
-        output_text = "".join(output_lines)
-        raise subprocess.CalledProcessError(
-            process.returncode, command, output=output_text.encode()
-        )
+
+def save_last_app_id(app_id: str) -> None:
+    LAST_APP_PATH.write_text(json.dumps({"app_id": app_id}), encoding="utf-8")
+
+
+def write_atomic(target_path: Path, payload: bytes) -> None:
+    """Writes through a temp file and rename so readers never see a partial file."""
+    # Dot-prefixed so a leftover from a crash is ignored by Gradle's resource
+    # merger instead of failing every later build
+    tmp_path = target_path.with_name(f".{target_path.name}.tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, target_path)
+
+
+def write_if_changed(target_path: Path, payload: bytes) -> None:
+    """Leaves identical files untouched so Gradle still sees them as up to date."""
+    try:
+        if target_path.read_bytes() == payload:
+            return
+    except FileNotFoundError:
+        pass
+    write_atomic(target_path, payload)
 
 
 def write_conf(app_id: str, name: str, target_path: Path) -> None:
-    content = f"id = {app_id}\nname = {name}\nicon = {ICON_FILENAME}\n"
-    target_path.write_text(content, encoding="utf-8")
+    payload = f"id = {app_id}\nname = {name}\nicon = {ICON_FILENAME}\n".encode()
+    write_atomic(target_path, payload)
 
 
 def overwrite_android_files(
@@ -736,8 +985,8 @@ def overwrite_android_files(
 
     # 1. Overwrite build.gradle
     gradle_path = ANDROID_DIR / "app/build.gradle"
-    gradle_content = BUILD_GRADLE_TEMPLATE.replace("APP_ID_PLACEHOLDER", app_id)
-    gradle_path.write_text(gradle_content, encoding="utf-8")
+    gradle_content = render_template(BUILD_GRADLE_PARTS, {"APP_ID": app_id})
+    write_if_changed(gradle_path, gradle_content.encode("utf-8"))
 
     # 2. Overwrite MainActivity.java
     package_dir = ANDROID_DIR / "app/src/main/java/com" / app_id / "htpk"
@@ -745,157 +994,276 @@ def overwrite_android_files(
 
     # Clean old files to prevent "Duplicate Class" errors
     src_root = ANDROID_DIR / "app/src/main/java"
-    for f in src_root.glob("**/MainActivity.java"):
-        if f.parent.resolve() != package_dir.resolve():
-            f.unlink()
+    last_app_id = load_last_app_id()
+    if last_app_id is None:
+        # No record of the previous package: check every com/<id>/htpk, the
+        # only place the templates ever put MainActivity.java
+        # (package_dir was just created, so com/ exists)
+        with os.scandir(src_root / "com") as entries:
+            for entry in entries:
+                if entry.name != app_id and entry.is_dir():
+                    stale = Path(entry.path, "htpk", "MainActivity.java")
+                    stale.unlink(missing_ok=True)
+    elif last_app_id != app_id:
+        shutil.rmtree(src_root / "com" / last_app_id / "htpk", ignore_errors=True)
 
     java_file = package_dir / "MainActivity.java"
 
     if git_info:
         # Use Git template with download/cache/update functionality
-        java_content = MAIN_ACTIVITY_GIT_TEMPLATE.replace("APP_ID_PLACEHOLDER", app_id)
-        java_content = java_content.replace("GIT_USER_PLACEHOLDER", git_info["user"])
-        java_content = java_content.replace("GIT_REPO_PLACEHOLDER", git_info["repo"])
-        java_content = java_content.replace(
-            "GIT_BRANCH_PLACEHOLDER", git_info["branch"]
+        java_content = render_template(
+            MAIN_ACTIVITY_GIT_PARTS,
+            {
+                "APP_ID": app_id,
+                "GIT_USER": git_info["user"],
+                "GIT_REPO": git_info["repo"],
+                "GIT_BRANCH": git_info["branch"],
+                "GIT_ENTRY": git_info["entry"],
+            },
         )
-        java_content = java_content.replace("GIT_ENTRY_PLACEHOLDER", git_info["entry"])
         print(f"[BUILDER] Using Git template for {git_info['user']}/{git_info['repo']}")
     else:
         # Standard template for URL/ZIP mode
-        java_content = MAIN_ACTIVITY_TEMPLATE.replace(
-            "APP_ID_PLACEHOLDER", app_id
-        ).replace("MAIN_URL_PLACEHOLDER", main_url)
+        java_content = render_template(
+            MAIN_ACTIVITY_PARTS, {"APP_ID": app_id, "MAIN_URL": main_url}
+        )
 
-    java_file.write_text(java_content, encoding="utf-8")
+    write_if_changed(java_file, java_content.encode("utf-8"))
+    save_last_app_id(app_id)
 
     # 3. Write strings.xml with the actual app name
     strings_path = ANDROID_DIR / "app/src/main/res/values/strings.xml"
     strings_path.parent.mkdir(parents=True, exist_ok=True)
     display_name = app_name if app_name else app_id
-    strings_path.write_text(
-        f'<resources>\n    <string name="app_name">{display_name}</string>\n</resources>',
-        encoding="utf-8",
-    )
+    strings_xml = f'<resources>\n    <string name="app_name">{display_name}</string>\n</resources>'
+    write_if_changed(strings_path, strings_xml.encode())
+
+
+def discard_tree(path: Path) -> None:
+    """Moves a directory out of the way and deletes it in the background."""
+    trash = CACHE_DIR / f"trash-{uuid.uuid4().hex}"
+    try:
+        path.rename(trash)
+    except OSError:
+        # e.g. cache/ on another filesystem: fall back to deleting in place
+        shutil.rmtree(path)
+        return
+    threading.Thread(
+        target=shutil.rmtree, args=(trash,), kwargs={"ignore_errors": True}, daemon=True
+    ).start()
+
+
+def empty_trash() -> None:
+    """Deletes trees discard_tree left behind when a previous run exited early."""
+    for trash in CACHE_DIR.glob("trash-*"):
+        shutil.rmtree(trash, ignore_errors=True)
+
+
+def extract_zip(archive: zipfile.ZipFile, dest: Path) -> None:
+    """Extracts a ZIP with less per-member overhead than ZipFile.extractall()."""
+    root = os.path.normpath(dest)
+    members = []
+    dirs = set()
+
+    for info in archive.infolist():
+        # Guard against "../" entries escaping the destination (zip-slip)
+        target = os.path.normpath(os.path.join(root, info.filename))
+        if target != root and not target.startswith(root + os.sep):
+            raise RuntimeError(f"Unsafe path in zip: {info.filename}")
+        if info.is_dir():
+            dirs.add(target)
+        else:
+            dirs.add(os.path.dirname(target))
+            members.append((info, target))
+
+    # Create every directory up front instead of once per member
+    for directory in dirs:
+        os.makedirs(directory, exist_ok=True)
+
+    for info, target in members:
+        if info.file_size == 0:
+            open(target, "wb").close()
+            continue
+        with archive.open(info) as src, open(target, "wb") as dst:
+            shutil.copyfileobj(src, dst, min(info.file_size, 1 << 20))
+
+
+def extract_assets(zip_file: tempfile.SpooledTemporaryFile) -> str:
+    """Unpacks the uploaded site into the APK assets and returns the index path."""
+    assets_dir = ANDROID_DIR / "app/src/main/assets"
+    if assets_dir.exists():
+        discard_tree(assets_dir)
+    assets_dir.mkdir(parents=True, exist_ok=True)
+
+    with zipfile.ZipFile(zip_file, "r") as z:
+        extract_zip(z, assets_dir)
+
+    # Find index.html
+    index_file = next((p for p in assets_dir.rglob("index.htm*")), None)
+    if not index_file:
+        raise RuntimeError("No index.html found in zip")
 
+    return str(index_file.relative_to(assets_dir)).replace("\\", "/")
+
+
+async def warm_gradle_daemon() -> None:
+    """Starts the Gradle daemon ahead of the first build so it skips JVM startup."""
+    async with build_semaphore:
+        try:
+            await run_command([*MAKE_COMMAND, "warm"], cwd=BASE_DIR)
+        except (OSError, subprocess.CalledProcessError) as e:
+            # Not fatal: the first build just starts the daemon itself
+            print(f"[BUILDER] Gradle warm-up skipped: {e}")
+
+
+def spool_upload(source) -> tempfile.SpooledTemporaryFile:
+    """Copies an upload into a temp file the build can hand straight to ZipFile."""
+    spooled = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_SIZE)
+    shutil.copyfileobj(source, spooled, UPLOAD_CHUNK_SIZE)
+    spooled.seek(0)
+    return spooled
+
+
+async def execute_build_async(build_id: str, data: dict) -> None:
+    record = build_states[build_id]
 
-def execute_build_async(build_id: str, data: dict) -> None:
     def update(progress, msg, status="in_progress", **kwargs):
-        with build_states_lock:
-            build_states[build_id].update(
-                {"progress": progress, "message": msg, "status": status, **kwargs}
+        record.update(progress=progress, message=msg, status=status, **kwargs)
+        # Re-insert so the TTL counts from the last activity rather than
+        # submission; a long queue would otherwise expire live builds
+        build_states[build_id] = record
+
+    if build_semaphore.locked():
+        update(0, "Queued: waiting for the current build to finish...")
+
+    async with build_semaphore:
+        try:
+            app_id, name = data["app_id"], data["name"]
+            app_output_dir = OUTPUT_DIR / app_id
+            app_output_dir.mkdir(parents=True, exist_ok=True)
+
+            update(5, "Preparing assets...")
+            await run_blocking(
+                (app_output_dir / ICON_FILENAME).write_bytes, data["icon_data"]
             )
 
-    try:
-        app_id, name = data["app_id"], data["name"]
-        app_output_dir = OUTPUT_DIR / app_id
-        app_output_dir.mkdir(parents=True, exist_ok=True)
-
-        update(5, "Preparing assets...")
-        (app_output_dir / ICON_FILENAME).write_bytes(data["icon_data"])
-
-        if data["zip_data"]:
-            # Local File Mode
-            assets_dir = ANDROID_DIR / "app/src/main/assets"
-            if assets_dir.exists():
-                shutil.rmtree(assets_dir)
-            assets_dir.mkdir(parents=True, exist_ok=True)
-
-            zip_path = app_output_dir / "assets.zip"
-            zip_path.write_bytes(data["zip_data"])
-            with zipfile.ZipFile(zip_path, "r") as z:
-                z.extractall(assets_dir)
-            zip_path.unlink()
-
-            # Find index.html
-            index_file = next((p for p in assets_dir.rglob("index.htm*")), None)
-            if not index_file:
-                raise RuntimeError("No index.html found in zip")
-
-            rel_path = str(index_file.relative_to(assets_dir)).replace("\\", "/")
-
-            # KEY FIX: Virtual Domain for ES Modules support
-            final_url = f"https://appassets.androidplatform.net/assets/{rel_path}"
-            git_info = None
-        elif data.get("git_url"):
-            # Git Repository Mode - Parse URL for offline-capable build
-            update(10, "Configuring Git repository...")
-            import urllib.parse
-
-            parsed = urllib.parse.urlparse(data["git_url"])
-            path = parsed.path.rstrip("/")
-            if path.endswith(".git"):
-                path = path[:-4]
-            parts = path.strip("/").split("/")
-            if len(parts) < 2:
-                raise ValueError(f"Invalid repository URL: {data['git_url']}")
-
-            git_info = {
-                "user": parts[0],
-                "repo": parts[1],
-                "branch": data.get("git_branch", "main"),
-                "entry": data.get("git_entry", "index.html"),
-            }
-            final_url = ""  # Not used for Git mode (app downloads content itself)
-            print(
-                f"[BUILDER] Git mode configured for {git_info['user']}/{git_info['repo']}"
+            if data["zip_file"]:
+                # Local File Mode
+                rel_path = await run_blocking(extract_assets, data["zip_file"])
+
+                # KEY FIX: Virtual Domain for ES Modules support
+                final_url = f"https://appassets.androidplatform.net/assets/{rel_path}"
+                git_info = None
+            elif data.get("git_url"):
+                # Git Repository Mode - Parse URL for offline-capable build
+                update(10, "Configuring Git repository...")
+                user, repo = parse_git_url(data["git_url"])
+
+                git_info = {
+                    "user": user,
+                    "repo": repo,
+                    "branch": data.get("git_branch", "main"),
+                    "entry": data.get("git_entry", "index.html"),
+                }
+                final_url = ""  # Not used for Git mode (app downloads content itself)
+                print(
+                    f"[BUILDER] Git mode configured for {git_info['user']}/{git_info['repo']}"
+                )
+            else:
+                # URL Mode
+                final_url = data["main_url"]
+                git_info = None
+
+            fingerprint = build_fingerprint(app_id, git_info)
+            reuse_cache = fingerprint == load_last_fingerprint()
+            # Forget the fingerprint before touching the tree, and only record
+            # the new one on success: a build killed midway may already have
+            # rewritten it for another app
+            save_last_fingerprint(None)
+            if not reuse_cache:
+                update(20, "Cleaning previous builds...")
+                # CRITICAL FIX: Clean build artifacts to prevent crashes from stale cache
+                # We ignore errors here in case clean fails on a fresh run
+                try:
+                    await run_command(
+                        [*MAKE_COMMAND, "clean_intermediates"],
+                        cwd=BASE_DIR,
+                    )
+                except (OSError, subprocess.CalledProcessError):
+                    pass
+            else:
+                # Same app and templates as the last successful build: keep
+                # Gradle's incremental outputs
+                update(20, "Reusing previous build cache...")
+
+            update(30, "Configuring project...")
+            conf_path = app_output_dir / CONF_FILENAME
+            await run_blocking(write_conf, app_id, name, conf_path)
+
+            # Run make.sh apply_config (handles Manifest updates)
+            await run_command(
+                [*MAKE_COMMAND, "apply_config", str(conf_path)],
+                cwd=BASE_DIR,
             )
-        else:
-            # URL Mode
-            final_url = data["main_url"]
-            git_info = None
 
-        update(20, "Cleaning previous builds...")
-        # CRITICAL FIX: Clean build artifacts to prevent crashes from stale cache
-        # We ignore errors here in case clean fails on a fresh run
-        try:
-            run_command(["bash", str(MAKE_SH_PATH), "clean"], cwd=BASE_DIR)
-        except:
-            pass
+            # Overwrite source code with correct templates (AssetLoader + Mixed Content)
+            update(45, "Injecting source code...")
+            await run_blocking(
+                overwrite_android_files, app_id, final_url, name, git_info
+            )
 
-        update(30, "Configuring project...")
-        conf_path = app_output_dir / CONF_FILENAME
-        write_conf(app_id, name, conf_path)
+            update(50, "Building APK...")
+            await run_gradle_with_progress(
+                [*MAKE_COMMAND, "apk"],
+                cwd=BASE_DIR,
+                record=record,
+                base_progress=50,
+                output_target_dir=app_output_dir,
+            )
 
-        # Run make.sh apply_config (handles Manifest updates)
-        run_command(
-            ["bash", str(MAKE_SH_PATH), "apply_config", str(conf_path)], cwd=BASE_DIR
-        )
+            update(96, "Verifying APK...")
+            final_apk = app_output_dir / f"{app_id}.apk"
+            if not final_apk.exists():
+                raise FileNotFoundError("APK build failed")
+
+            update(98, "Finalizing...")
+            save_last_fingerprint(fingerprint)
+            update(
+                100,
+                "Done!",
+                "complete",
+                apk_path=str(final_apk),
+                apk_filename=f"{app_id}_release.apk",
+            )
 
-        # Overwrite source code with correct templates (AssetLoader + Mixed Content)
-        update(45, "Injecting source code...")
-        overwrite_android_files(app_id, final_url, name, git_info)
-
-        update(50, "Building APK...")
-        run_gradle_with_progress(
-            ["bash", str(MAKE_SH_PATH), "apk"],
-            cwd=BASE_DIR,
-            build_id=build_id,
-            base_progress=50,
-            output_target_dir=app_output_dir,
-        )
+        except subprocess.CalledProcessError as e:
+            error_msg = f"Command failed: {e.cmd}\nOutput:\n{e.stdout.decode('utf-8', errors='replace')}"
+            print(f"Build Error: {error_msg}")
+            # Force a clean on the next build in case stale outputs caused this
+            save_last_fingerprint(None)
+            update(
+                0, "Build failed. Check console for details.", "error", error=error_msg
+            )
+        except Exception as e:
+            print(f"Build Error: {e}")
+            save_last_fingerprint(None)
+            update(0, f"Error: {str(e)}", "error", error=str(e))
+        finally:
+            if data["zip_file"]:
+                data["zip_file"].close()
 
-        update(96, "Verifying APK...")
-        final_apk = app_output_dir / f"{app_id}.apk"
-        if not final_apk.exists():
-            raise FileNotFoundError("APK build failed")
-
-        update(98, "Finalizing...")
-        update(
-            100,
-            "Done!",
-            "complete",
-            apk_path=str(final_apk),
-            apk_filename=f"{app_id}_release.apk",
-        )
 
-    except subprocess.CalledProcessError as e:
-        error_msg = f"Command failed: {e.cmd}\nOutput:\n{e.stdout.decode('utf-8', errors='replace')}"
-        print(f"Build Error: {error_msg}")
-        update(0, "Build failed. Check console for details.", "error", error=error_msg)
-    except Exception as e:
-        print(f"Build Error: {e}")
-        update(0, f"Error: {str(e)}", "error", error=str(e))
+def start_background_task(tasks: set[asyncio.Task], coro) -> None:
+    """Runs coro detached; if it fails, the other builds carry on."""
+    task = asyncio.create_task(coro)
+    tasks.add(task)
+
+    def done(task: asyncio.Task) -> None:
+        tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            print(f"[BUILDER] Background task failed: {task.exception()!r}")
+
+    task.add_done_callback(done)
 
 
 # --- ROUTES ---
@@ -904,90 +1272,120 @@ def execute_build_async(build_id: str, data: dict) -> None:
 @post("/build-app")
 async def build_apk(
     data: Annotated[dict, Body(media_type=RequestEncodingType.MULTI_PART)],
+    state: State,
 ) -> dict:
     build_id = str(uuid.uuid4())
-    with build_states_lock:
-        build_states[build_id] = {
-            "status": "in_progress",
-            "progress": 0,
-            "message": "Starting...",
-        }
+    build_states[build_id] = BuildRecord()
 
     thread_data = {
         "app_id": data["app_id"],
         "name": data["name"],
         "icon_data": await data["icon"].read(),
         "main_url": data.get("main_url"),
-        "zip_data": await data["zip_file"].read() if data.get("zip_file") else None,
+        "zip_file": (
+            # Off the event loop: the upload may already have spilled to disk
+            await asyncio.to_thread(spool_upload, data["zip_file"].file)
+            if data.get("zip_file")
+            else None
+        ),
         "git_url": data.get("git_url"),
         "git_branch": data.get("git_branch", "main"),
         "git_entry": data.get("git_entry", "index.html"),
     }
-    threading.Thread(
-        target=execute_build_async, args=(build_id, thread_data), daemon=True
-    ).start()
+    start_background_task(state.build_tasks, execute_build_async(build_id, thread_data))
     return {"build_id": build_id}
 
 
 @get("/build-progress/{build_id:str}")
 async def stream_progress(build_id: str) -> Stream:
-    async def generator():
-        last = None
-        while True:
-            with build_states_lock:
-                state = build_states.get(build_id)
-            if not state:
-                yield f"event: error\ndata: {json.dumps({'error': 'Invalid ID'})}\n\n"
-                break
+    record = build_states.get(build_id)
 
-            if state != last:
-                yield f"data: {json.dumps(state)}\n\n"
-                last = state.copy()
+    async def generator():
+        if not record:
+            yield INVALID_ID_FRAME
+            return
 
-            if state["status"] == "complete":
-                yield f"event: complete\ndata: {json.dumps({'build_id': build_id})}\n\n"
+        last_seq = None
+        while True:
+            changed = record.changed
+            frame = record.frame if record.seq != last_seq else b""
+            last_seq = record.seq
+
+            # The final state and its event go out together in one write
+            state = record.state
+            if state.status == "complete":
+                yield frame + sse_frame({"build_id": build_id}, "complete")
                 break
-            if state["status"] == "error":
-                yield f"event: error\ndata: {json.dumps({'error': state.get('error')})}\n\n"
+            if state.status == "error":
+                yield frame + sse_frame({"error": state.error}, "error")
                 break
-            await asyncio.sleep(0.5)
+            if frame:
+                yield frame
+            await changed.wait()
 
     return Stream(generator(), media_type="text/event-stream")
 
 
 @get("/download-apk/{build_id:str}")
 async def download(build_id: str) -> File:
-    with build_states_lock:
-        state = build_states.get(build_id)
-    if not state or state["status"] != "complete":
+    record = build_states.get(build_id)
+    if not record or record.state.status != "complete":
         raise RuntimeError("Not ready")
+    state = record.state
+    apk_path = Path(state.apk_path)
     return File(
-        path=Path(state["apk_path"]),
-        filename=state["apk_filename"],
+        path=apk_path,
+        filename=state.apk_filename,
         media_type="application/vnd.android.package-archive",
+        # Reuse our stat instead of a second lookup in a worker thread
+        stat_result=apk_path.stat(),
+        chunk_size=APK_CHUNK_SIZE,
     )
 
 
 # --- RUN ---
-cors = CORSConfig(allow_origins=["*"])
-app = Litestar(route_handlers=[build_apk, stream_progress, download], cors_config=cors)
+@asynccontextmanager
+async def build_task_group(app: Litestar) -> AsyncGenerator[None, None]:
+    """Owns all background builds; shutdown cancels the ones still pending."""
+    tasks = set()
+    app.state.build_tasks = tasks
+    start_background_task(tasks, warm_gradle_daemon())
+    threading.Thread(target=empty_trash, daemon=True).start()
+    try:
+        yield
+    finally:
+        # Queued builds never start, and cancelling the running one kills its
+        # make.sh/Gradle children (see run_command)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        BUILD_POOL.shutdown(cancel_futures=True)
 
 
-class ReusableTCPServer(socketserver.TCPServer):
-    allow_reuse_address = True
+cors = CORSConfig(allow_origins=["*"])
+app = Litestar(
+    route_handlers=[
+        build_apk,
+        stream_progress,
+        download,
+        # The web UI is served by the same server as the API
+        create_static_files_router(path="/", directories=[WEB_DIR], html_mode=True),
+    ],
+    cors_config=cors,
+    lifespan=[build_task_group],
+)
 
 
 if __name__ == "__main__":
     import uvicorn
 
-    os.chdir(WEB_DIR)
-
-    def serve_front():
-        handler = http.server.SimpleHTTPRequestHandler
-        with ReusableTCPServer(("", 9742), handler) as httpd:
-            print(f"[FRONTEND] http://localhost:9742")
-            httpd.serve_forever()
-
-    threading.Thread(target=serve_front, daemon=True).start()
+    print("[FRONTEND] http://localhost:9741")
     print("[BACKEND] http://0.0.0.0:9741")
-    uvicorn.run(app, host="0.0.0.0", port=9741, log_level="error")
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=9741,
+        log_level="error",
+        loop="uvloop",
+        http="httptools",
+    )
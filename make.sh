@@ -60,17 +60,29 @@ apk() {
     echo "sdk.dir=$ANDROID_HOME" > local.properties
     
     # Build using local Gradle and cache
-    try gradle assembleRelease --project-cache-dir "$CACHE_ROOT/.gradle"
+    try gradle assembleRelease --parallel --build-cache --configure-on-demand \
+        --project-cache-dir "$CACHE_ROOT/.gradle"
     
     if [ -f "app/build/outputs/apk/release/app-release.apk" ]; then
         log "APK Built Successfully!"
-        cp "app/build/outputs/apk/release/app-release.apk" "$OUTPUT_DEST/$appname.apk"
+        # Hardlink when output/ shares the filesystem; the APK is removed before
+        # every build, so Gradle never rewrites the linked copy in place
+        ln -f "app/build/outputs/apk/release/app-release.apk" "$OUTPUT_DEST/$appname.apk" 2>/dev/null \
+            || cp "app/build/outputs/apk/release/app-release.apk" "$OUTPUT_DEST/$appname.apk"
         log "Saved to $OUTPUT_DEST/$appname.apk"
     else
         error "Build failed"
     fi
 }
 
+warm() {
+    ensure_deps
+    info "Warming up Gradle daemon..."
+    echo "sdk.dir=$ANDROID_HOME" > local.properties
+    # Same project cache dir as apk() so the daemon and caches are reused
+    try gradle help --quiet --project-cache-dir "$CACHE_ROOT/.gradle"
+}
+
 apply_config() {
     local config_file="${1:-webapk.conf}"
     [ ! -f "$config_file" ] && return
@@ -128,6 +140,13 @@ clean() {
     try rm -rf "$CACHE_ROOT/.gradle"
 }
 
+clean_intermediates() {
+    # Drops compiled classes and generated sources (R, BuildConfig) that may
+    # still carry the old package, but keeps Gradle's project cache
+    info "Cleaning intermediate build files..."
+    try rm -rf app/build/intermediates app/build/generated app/build/tmp
+}
+
 chid() {
     [ -z "$1" ] && return 0
     [[ ! $1 =~ ^[a-zA-Z][a-zA-Z0-9_]*$ ]] && error "Invalid App ID"
@@ -160,7 +179,9 @@ rename() {
         if [ -f "$xml_file" ]; then
             escaped_name=$(echo "$new_name" | sed 's/[\/&]/\\&/g')
             # Use temporary file for sed to avoid issues
-            sed "s|<string name=\"app_name\">[^<]*</string>|<string name=\"app_name\">$escaped_name</string>|" "$xml_file" > "${xml_file}.tmp" && mv "${xml_file}.tmp" "$xml_file"
+            sed "s|<string name=\"app_name\">[^<]*</string>|<string name=\"app_name\">$escaped_name</string>|" "$xml_file" > "${xml_file}.tmp"
+            # Only replace the file when the name changed, keeping its mtime otherwise
+            if cmp -s "${xml_file}.tmp" "$xml_file"; then rm -f "${xml_file}.tmp"; else mv "${xml_file}.tmp" "$xml_file"; fi
         fi
     done || true
 }
@@ -175,7 +196,7 @@ set_icon() {
     
     if [ -f "$icon_path" ]; then
         mkdir -p "$dest_dir"
-        cp "$icon_path" "$dest_file" 2>/dev/null || true
+        cmp -s "$icon_path" "$dest_file" || cp "$icon_path" "$dest_file" 2>/dev/null || true
     fi
 }
 
@@ -1,10 +1,14 @@
 import os
 import sys
+import hashlib
 import shutil
 import tarfile
 import zipfile
 import subprocess
+import threading
+import urllib.error
 import urllib.request
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
 from pathlib import Path
 
 # --- CONFIGURATION ---
@@ -19,33 +23,104 @@ JDK_URL = "https://download.java.net/java/GA/jdk17.0.2/dfd4a8d0985749f896bed50d7
 GRADLE_URL = "https://services.gradle.org/distributions/gradle-7.4-bin.zip"
 CMDLINE_TOOLS_URL = "https://dl.google.com/android/repository/commandlinetools-linux-9477386_latest.zip"
 
+# Published SHA-256 checksums of the archives above
+JDK_SHA256 = "0022753d0cceecacdd3a795dd4cea2bd7ffdf9dc06e22ffd1be98411742fbb44"
+GRADLE_SHA256 = "8cc27038d5dbd815759851ba53e70cf62e481b87494cc97cfd97982ada5ba634"
+CMDLINE_TOOLS_SHA256 = "bd1aa17c7ef10066949c88dc6c9c8d536be27f992a1f3b5a584f9bd2ba5646a0"
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
 # Paths inside lib/
 JAVA_HOME = LIB_DIR / "jvm" / "jdk-17.0.2"
 GRADLE_HOME = LIB_DIR / "gradle" / "gradle-7.4"
 ANDROID_HOME = LIB_DIR / "cmdline-tools"
 CMDLINE_TOOLS_BIN = ANDROID_HOME / "latest" / "bin"
 
+# SDK packages the build needs; each installs into ANDROID_HOME/<name with ';' as '/'>
+# OPTIMIZATION: Included 'build-tools;30.0.3' to prevent Gradle from downloading it during build
+SDK_PACKAGES = [
+    "platform-tools",
+    "platforms;android-33",
+    "build-tools;33.0.0",
+    "build-tools;30.0.3",
+]
+
+# Set when one setup step fails, so the others stop at their next chunk
+abort_setup = threading.Event()
+
 def log(msg):
     print(f"[SETUP] {msg}")
 
-def download_file(url, dest_path):
+def check_aborted():
+    if abort_setup.is_set():
+        raise RuntimeError("Setup aborted")
+
+def hash_file(path, digest):
+    with open(path, "rb") as f:
+        while chunk := f.read(DOWNLOAD_CHUNK_SIZE):
+            digest.update(chunk)
+
+def download_file(url, dest_path, sha256=None):
     if dest_path.exists():
         return
-    log(f"Downloading {url}...")
+
+    # Partial downloads are kept next to the target and resumed on the next run
+    part_path = dest_path.with_name(dest_path.name + ".part")
+    offset = part_path.stat().st_size if part_path.exists() else 0
+    digest = hashlib.sha256()
+    log(f"Downloading {url}..." if not offset else f"Resuming {url} at {offset} bytes...")
     try:
-        urllib.request.urlretrieve(url, dest_path)
+        request = urllib.request.Request(url, headers={"Range": f"bytes={offset}-"} if offset else {})
+        with urllib.request.urlopen(request) as response:
+            if offset and response.status != 206:
+                # Server ignored the range: start over
+                offset = 0
+            if offset:
+                hash_file(part_path, digest)
+            with open(part_path, "ab" if offset else "wb") as out:
+                while chunk := response.read(DOWNLOAD_CHUNK_SIZE):
+                    check_aborted()
+                    digest.update(chunk)
+                    out.write(chunk)
+    except urllib.error.HTTPError as e:
+        if not (offset and e.code == 416):
+            raise RuntimeError(f"Error downloading {url}: {e}") from e
+        # Range starts at the end: the previous run already got everything
+        hash_file(part_path, digest)
     except Exception as e:
-        print(f"Error downloading {url}: {e}")
-        sys.exit(1)
+        raise RuntimeError(f"Error downloading {url}: {e}") from e
+
+    if sha256 and digest.hexdigest() != sha256:
+        part_path.unlink()
+        raise RuntimeError(f"Checksum mismatch for {url}: expected {sha256}, got {digest.hexdigest()}")
+    part_path.rename(dest_path)
 
 def extract_archive(file_path, extract_to):
     log(f"Extracting {file_path.name}...")
-    if file_path.name.endswith(".tar.gz"):
-        with tarfile.open(file_path, "r:gz") as tar:
-            tar.extractall(path=extract_to)
-    elif file_path.name.endswith(".zip"):
-        with zipfile.ZipFile(file_path, "r") as zip_ref:
-            zip_ref.extractall(path=extract_to)
+    # Unpack into a staging dir and only move the result into place once it is
+    # complete, so an aborted or failed run never leaves a half-installed tool
+    staging = extract_to / f".extracting-{file_path.name}"
+    shutil.rmtree(staging, ignore_errors=True)
+    try:
+        if file_path.name.endswith(".tar.gz"):
+            # Stream members one by one instead of building the full member list,
+            # refusing anything that would land outside the staging dir
+            with tarfile.open(file_path, "r|gz") as tar:
+                for member in tar:
+                    check_aborted()
+                    tar.extract(member, path=staging, filter="data")
+        elif file_path.name.endswith(".zip"):
+            with zipfile.ZipFile(file_path, "r") as zip_ref:
+                for member in zip_ref.infolist():
+                    check_aborted()
+                    zip_ref.extract(member, path=staging)
+
+        for entry in staging.iterdir():
+            target = extract_to / entry.name
+            if target.is_dir():
+                shutil.rmtree(target)
+            entry.rename(target)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
 
 def setup_java():
     if JAVA_HOME.exists():
@@ -60,7 +135,7 @@ def setup_java():
     jvm_dir.mkdir(parents=True, exist_ok=True)
     
     archive = jvm_dir / "jdk.tar.gz"
-    download_file(JDK_URL, archive)
+    download_file(JDK_URL, archive, JDK_SHA256)
     extract_archive(archive, jvm_dir)
     archive.unlink() # Cleanup
 
@@ -82,7 +157,7 @@ def setup_gradle():
     gradle_dir.mkdir(parents=True, exist_ok=True)
 
     archive = gradle_dir / "gradle.zip"
-    download_file(GRADLE_URL, archive)
+    download_file(GRADLE_URL, archive, GRADLE_SHA256)
     extract_archive(archive, gradle_dir)
     archive.unlink()
 
@@ -91,25 +166,31 @@ def setup_gradle():
     if gradle_bin.exists():
         os.chmod(gradle_bin, 0o755)
 
-def setup_android_sdk():
+def setup_cmdline_tools():
     target_dir = ANDROID_HOME / "latest"
     if target_dir.exists():
         log("Android Command Line Tools are already installed.")
-    else:
-        ANDROID_HOME.mkdir(parents=True, exist_ok=True)
-        archive = ANDROID_HOME / "tools.zip"
-        download_file(CMDLINE_TOOLS_URL, archive)
-        extract_archive(archive, ANDROID_HOME)
-        archive.unlink()
-
-        # Rename extracted 'cmdline-tools' to 'latest'
-        extracted_folder = ANDROID_HOME / "cmdline-tools"
-        if extracted_folder.exists():
-            extracted_folder.rename(target_dir)
-    
-    # Install Platforms and Build Tools
-    # OPTIMIZATION: Included 'build-tools;30.0.3' to prevent Gradle from downloading it during build
-    log("Checking/Installing Android SDK packages...")
+        return
+
+    ANDROID_HOME.mkdir(parents=True, exist_ok=True)
+    archive = ANDROID_HOME / "tools.zip"
+    download_file(CMDLINE_TOOLS_URL, archive, CMDLINE_TOOLS_SHA256)
+    extract_archive(archive, ANDROID_HOME)
+    archive.unlink()
+
+    # Rename extracted 'cmdline-tools' to 'latest'
+    extracted_folder = ANDROID_HOME / "cmdline-tools"
+    if extracted_folder.exists():
+        extracted_folder.rename(target_dir)
+
+def setup_android_sdk():
+    # Install Platforms and Build Tools, skipping the sdkmanager JVM entirely
+    # when everything is already in place
+    missing = [pkg for pkg in SDK_PACKAGES if not (ANDROID_HOME / pkg.replace(";", "/")).exists()]
+    if not missing:
+        log("Android SDK packages are already installed.")
+        return
+    log(f"Installing Android SDK packages: {', '.join(missing)}...")
     
     # Set up environment for sdkmanager
     env = os.environ.copy()
@@ -123,19 +204,13 @@ def setup_android_sdk():
         os.chmod(sdkmanager, 0o755)
 
     # Accept licenses and install
-    cmd = [
-        str(sdkmanager),
-        "platform-tools",
-        "platforms;android-33",
-        "build-tools;33.0.0",
-        "build-tools;30.0.3", 
-        f"--sdk_root={ANDROID_HOME}"
-    ]
+    cmd = [str(sdkmanager), *missing, f"--sdk_root={ANDROID_HOME}"]
     
-    # Pipe 'yes' to accept licenses
-    yes_proc = subprocess.Popen(["yes"], stdout=subprocess.PIPE)
-    subprocess.run(cmd, stdin=yes_proc.stdout, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
-    yes_proc.stdout.close() # Clean up
+    # Answer 'y' to every license prompt without spawning 'yes'
+    try:
+        subprocess.run(cmd, input=b"y\n" * 200, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"sdkmanager exited with status {e.returncode}:\n{e.stderr.decode(errors='replace')}") from e
 
 def generate_keystore():
     keystore_path = ANDROID_DIR / "app" / "my-release-key.jks"
@@ -175,8 +250,17 @@ def main():
 
     # Run Setup Steps
     try:
-        setup_java()
-        setup_gradle()
+        # The three toolchains are independent: download and unpack them together
+        with ThreadPoolExecutor(max_workers=3) as pool:
+            jobs = [pool.submit(step) for step in (setup_java, setup_gradle, setup_cmdline_tools)]
+            done, _ = wait(jobs, return_when=FIRST_EXCEPTION)
+            failed = [job for job in done if job.exception()]
+            if failed:
+                # Don't sit through the other multi-hundred-MB steps
+                abort_setup.set()
+                pool.shutdown(cancel_futures=True)
+                raise failed[0].exception()
+        # sdkmanager needs both the JDK and the command line tools
         setup_android_sdk()
         setup_keystore = generate_keystore()
     except Exception as e: